@@ -5,15 +5,24 @@ import shutil
 import logging
 import time
 import re
-from typing import List, Optional
+import json
+import functools
+import sqlite3
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import IO, List, Optional
 from urllib.parse import urljoin, urlparse
 import tempfile
 import subprocess
 
 import httpx
-import requests
+from aiolimiter import AsyncLimiter
 from PIL import Image
-from bs4 import BeautifulSoup
+from selectolax.parser import HTMLParser
+
+from parsing import parse_media, url_basename
 from telegram import Bot, Update, InputMediaPhoto, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode, ChatAction
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
@@ -35,6 +44,9 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 CHANNEL_ID = int(os.getenv("CHANNEL_ID", "-1002900910545"))
 DOWNLOAD_DIR = "downloads"
 MAX_VIDEOS_PER_LIST = int(os.getenv("MAX_VIDEOS", 200))
+SENT_CACHE_PATH = os.getenv("SENT_CACHE_PATH", os.path.join(DOWNLOAD_DIR, "sent_media.db"))
+SENT_CACHE_MAX_ENTRIES = int(os.getenv("SENT_CACHE_MAX_ENTRIES", 100000))
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", 2))
 
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
@@ -43,27 +55,148 @@ HTTP_HEADERS = {
     "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8"
 }
 
-async_client = httpx.AsyncClient(headers=HTTP_HEADERS, follow_redirects=True, timeout=30)
-
-IGNORED_MEDIA_PATTERNS = [
-    "/avatars/", "/styles/", "/smilies/", "/assets/",
-    "cdninstagram.com", "/addonflare/", "/icons/"
-]
-
 # Global state
-SENT_MEDIA_URLS = set()
 cancellation_flags = {}
 processing_tasks = {}
 user_modes = {}
+chat_queues = {}
+chat_workers = {}
+status_edit_times = {}
 LINK_PROCESSING_INTERVAL = 10
+STATUS_EDIT_INTERVAL = 1.5
+MAX_CONCURRENT_PAGES = 8
+MAX_CONCURRENT_DOWNLOADS = 16
+DOWNLOAD_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+MEDIA_GROUP_SIZE = 10
+DOWNLOAD_SPOOL_SIZE = 4 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Telegram allows roughly 30 messages per minute into a channel
+SEND_LIMITER = AsyncLimiter(30, 60)
+flood_wait_until = 0.0
+
+# Parse pool workers import this module again as __mp_main__, so the
+# client, cache and pool are created in main() instead of at import
+async_client: Optional[httpx.AsyncClient] = None
+sent_cache: Optional["SentCache"] = None
+parse_pool: Optional[ProcessPoolExecutor] = None
+
+# HTML parsing is CPU-bound, keep it off the event loop. Workers come
+# from a forkserver since forking the threaded bot process can deadlock.
+def _new_parse_pool() -> ProcessPoolExecutor:
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["parsing"])
+    return ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=context)
+
+# ========================
+# COMPILED PATTERNS
+# ========================
+_MD_ESCAPE_RE = re.compile(r'([\\_*\[\]()~`>#+\-=|{}.!])')
+_URL_RE = re.compile(r'https?://[^\s<>"]+|www\.[^\s<>"]+')
+_URL_LINE_RE = re.compile(r'^\s*(http.*?)\s*$', re.MULTILINE)
+_FN_BAD_RE = re.compile(r'[:*?"<>|/\\]')
+_DIRECT_VIDEO_RE = re.compile(r'\.(mp4|mpd|avi|mov|wmv|mkv|webm)$', re.IGNORECASE)
+_VIDEO_EXT_RE = re.compile(r'\.(mp4|mpd)(\?.*)?$', re.IGNORECASE)
+_NEXT_TEXT_RE = re.compile(r'^\s*Next\s*$', re.IGNORECASE)
+
+_SCRIPT_VIDEO_PATTERNS = (
+    re.compile(r'htmlplayer\.setVideoUrl\("([^"]+)"\)', re.IGNORECASE),
+    re.compile(r'"video_url":"([^"]+)"', re.IGNORECASE),
+    re.compile(r'file:\s*"([^"]+)"', re.IGNORECASE),
+)
+_SCRIPT_DIRECT_VIDEO_RE = re.compile(r'https?://[^\s<>"]*\.(?:mp4|mpd)[^\s<>"]*', re.IGNORECASE)
+
+_JSONISH_RE = re.compile(r'"(?:video_url|file|fileURL)"\s*:')
+_JSON_VIDEO_KEYS = frozenset(("video_url", "file", "fileURL"))
+_JSON_DECODER = json.JSONDecoder()
+_JSON_MAX_BRACE_TRIES = 64
+
+_EMBED_RE = re.compile(
+    r'''file:\s*"(?P<file>[^"]+)"'''
+    r'''|<source\s+src="(?P<src>[^"]+)"'''
+    r'''|"fileURL":"(?P<furl>[^"]+)"'''
+    r'''|(?P<direct>https?://[^\s"'<>`]+?\.(?:mp4|m3u8|mkv|webm)[^\s"'<>`]*)''',
+    re.IGNORECASE
+)
+
+# ========================
+# SENT MEDIA CACHE
+# ========================
+class SentCache:
+    """Persistent record of media URLs already sent to the channel"""
+    
+    MEMORY_SIZE = 4096
+    TRIM_INTERVAL = 1000
+    QUERY_BATCH_SIZE = 500
+    
+    def __init__(self, path: str, max_entries: int):
+        self.max_entries = max_entries
+        self._recent = OrderedDict()
+        self._adds = 0
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY)")
+        self._db.commit()
+    
+    def _remember(self, url: str):
+        """Keep url in the in-memory LRU front"""
+        self._recent[url] = None
+        self._recent.move_to_end(url)
+        if len(self._recent) > self.MEMORY_SIZE:
+            self._recent.popitem(last=False)
+    
+    def add_many(self, urls: list):
+        """Mark urls as sent in one transaction"""
+        for url in urls:
+            self._remember(url)
+        # REPLACE gives the row a new rowid, so rowid order is recency order
+        self._db.executemany("INSERT OR REPLACE INTO urls (url) VALUES (?)", ((url,) for url in urls))
+        self._db.commit()
+        
+        self._adds += len(urls)
+        if self._adds >= self.TRIM_INTERVAL:
+            self._adds = 0
+            self._trim()
+    
+    def _trim(self):
+        """Drop the oldest rows beyond max_entries"""
+        self._db.execute(
+            "DELETE FROM urls WHERE rowid IN "
+            "(SELECT rowid FROM urls ORDER BY rowid DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+        self._db.commit()
+    
+    def filter_new(self, urls: list) -> list:
+        """Return URLs not sent yet, keeping their order"""
+        unique = dict.fromkeys(urls)
+        pending = list(unique.keys() - self._recent.keys())
+        if not pending: return []
+        
+        sent = set()
+        for i in range(0, len(pending), self.QUERY_BATCH_SIZE):
+            batch = pending[i:i + self.QUERY_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            rows = self._db.execute(f"SELECT url FROM urls WHERE url IN ({placeholders})", batch)
+            sent.update(row[0] for row in rows)
+        
+        for url in sent:
+            self._remember(url)
+        new = set(pending) - sent
+        if len(new) == len(unique):
+            return list(unique)
+        return [url for url in unique if url in new]
+    
+    def close(self):
+        self._db.close()
 
 # ========================
 # UTILITY FUNCTIONS
 # ========================
 def escape_markdown_v2(text: str) -> str:
     """Escape special characters for Telegram MarkdownV2"""
-    escape_chars = r'\_*[]()~`>#+-=|{}.!'
-    return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
+    return _MD_ESCAPE_RE.sub(r'\\\1', text)
 
 def check_ffmpeg():
     """Check if ffmpeg is installed"""
@@ -94,9 +227,18 @@ def format_progress(total_counts, processed_counts, extra=""):
     progress = " | ".join(parts)
     return f"{progress}\n\n{extra}" if extra else progress
 
-async def update_status_safe(msg, text):
-    """Safely update status message"""
+async def update_status_safe(msg, text, throttle: bool = False):
+    """Safely update status message, throttled edits are skipped if too frequent"""
     if not msg: return
+    
+    # Message objects are immutable, so track edit times by message key
+    if throttle:
+        key = (msg.chat_id, msg.message_id)
+        now = time.monotonic()
+        if now - status_edit_times.get(key, 0.0) < STATUS_EDIT_INTERVAL:
+            return
+        status_edit_times[key] = now
+    
     try:
         if msg.text != text:
             await msg.edit_text(text, parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True)
@@ -108,20 +250,20 @@ async def update_status_safe(msg, text):
 
 def find_urls_in_text(text: str) -> List[str]:
     """Extract URLs from text"""
-    return re.findall(r'https?://[^\s<>"]+|www\.[^\s<>"]+', text)
+    return _URL_RE.findall(text)
 
 def safe_filename(name: str) -> str:
     """Make filename safe"""
-    return re.sub(r'[:*?"<>|/\\]', "_", name)
+    return _FN_BAD_RE.sub("_", name)
 
 def is_direct_video_link(url: str) -> bool:
     """Check if URL is direct video link"""
-    video_extensions = ['.mp4', '.mpd', '.avi', '.mov', '.wmv', '.mkv', '.webm']
-    return any(url.lower().endswith(ext) for ext in video_extensions)
+    return bool(_DIRECT_VIDEO_RE.search(url))
 
 # ========================
 # VIDEO LINK EXTRACTOR (MODE 1)
 # ========================
+@functools.lru_cache(maxsize=4096)
 def make_absolute_url(url: str, base_url: str) -> Optional[str]:
     """Convert relative URL to absolute"""
     if not url: return None
@@ -132,46 +274,92 @@ def make_absolute_url(url: str, base_url: str) -> Optional[str]:
         return f"{base.scheme}://{base.netloc}{url}"
     return urljoin(base_url, url)
 
-def extract_video_links_from_html(html_content: str, base_url: str) -> List[tuple]:
+def _decode_enclosing_json(text: str, pos: int) -> Optional[tuple]:
+    """Decode the JSON object enclosing pos, returns (object, end) or None"""
+    start = pos
+    for _ in range(_JSON_MAX_BRACE_TRIES):
+        start = text.rfind('{', 0, start)
+        if start < 0: break
+        try:
+            blob, end = _JSON_DECODER.raw_decode(text, start)
+        except ValueError:
+            continue
+        if end > pos:
+            return blob, end
+    return None
+
+def _walk_json_videos(node):
+    """Yield video URL values from decoded JSON"""
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key in _JSON_VIDEO_KEYS and isinstance(value, str):
+                # "file" is also used for subtitle and thumbnail tracks
+                if key != "file" or _VIDEO_EXT_RE.search(value) or _DIRECT_VIDEO_RE.search(value):
+                    yield value
+            else:
+                yield from _walk_json_videos(value)
+    elif isinstance(node, list):
+        for item in node:
+            yield from _walk_json_videos(item)
+
+def extract_json_video_urls(script_text: str) -> List[str]:
+    """Extract video URLs from JSON player payloads in a script"""
+    urls = []
+    pos = 0
+    while True:
+        match = _JSONISH_RE.search(script_text, pos)
+        if not match: break
+        pos = match.end()
+        
+        decoded = _decode_enclosing_json(script_text, match.start())
+        if not decoded: continue
+        blob, end = decoded
+        urls.extend(_walk_json_videos(blob))
+        pos = max(pos, end)
+    return urls
+
+def extract_video_links_from_html(html_content: bytes, base_url: str) -> List[tuple]:
     """Extract video links from HTML"""
-    soup = BeautifulSoup(html_content, 'html.parser')
-    page_title = soup.title.string.strip() if soup.title else "Untitled"
+    dom = HTMLParser(html_content)
+    title_node = dom.css_first('title')
+    page_title = (title_node.text().strip() if title_node else "") or "Untitled"
     video_links = []
+    seen = set()
     
     # Search in scripts
-    for script in soup.find_all('script'):
-        if script.string:
-            patterns = [
-                r'htmlplayer\.setVideoUrl\("([^"]+)"\)',
-                r'"video_url":"([^"]+)"',
-                r'file:\s*"([^"]+)"',
-                r'https?://[^\s<>"]*\.(?:mp4|mpd)[^\s<>"]*'
+    for script in dom.css('script'):
+        script_text = script.text()
+        if script_text:
+            # Prefer a single JSON pass, fall back to player regex scans
+            matches = extract_json_video_urls(script_text) or [
+                match for pattern in _SCRIPT_VIDEO_PATTERNS
+                for match in pattern.findall(script_text)
             ]
-            for pattern in patterns:
-                matches = re.findall(pattern, script.string, re.IGNORECASE)
-                for match in matches:
-                    url = match if isinstance(match, str) else match[0]
-                    absolute_url = make_absolute_url(url, base_url)
-                    if absolute_url and absolute_url not in [v[1] for v in video_links]:
-                        video_links.append((page_title, absolute_url))
+            matches += _SCRIPT_DIRECT_VIDEO_RE.findall(script_text)
+            for match in matches:
+                url = match if isinstance(match, str) else match[0]
+                absolute_url = make_absolute_url(url, base_url)
+                if absolute_url and absolute_url not in seen:
+                    seen.add(absolute_url)
+                    video_links.append((page_title, absolute_url))
     
     # Search in tags
-    for tag in soup.find_all(['video', 'source', 'a', 'iframe']):
-        url = tag.get('src') or tag.get('href')
-        if url and re.search(r'\.(mp4|mpd)(\?.*)?$', url, re.IGNORECASE):
+    for tag in dom.css('video, source, a, iframe'):
+        url = tag.attributes.get('src') or tag.attributes.get('href')
+        if url and _VIDEO_EXT_RE.search(url):
             absolute_url = make_absolute_url(url, base_url)
-            if absolute_url and absolute_url not in [v[1] for v in video_links]:
+            if absolute_url and absolute_url not in seen:
+                seen.add(absolute_url)
                 video_links.append((page_title, absolute_url))
     
     return video_links[:5]  # Limit results
 
-def extract_video_links(url: str) -> List[tuple]:
+async def extract_video_links(url: str) -> List[tuple]:
     """Extract video links from single page"""
     try:
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'}
-        response = requests.get(url, headers=headers, timeout=15)
+        response = await async_client.get(url, timeout=15)
         response.raise_for_status()
-        return extract_video_links_from_html(response.text, url)
+        return extract_video_links_from_html(response.content, url)
     except Exception as e:
         logger.error(f"Error extracting from {url}: {e}")
         return []
@@ -194,22 +382,28 @@ async def scrape_embedded_video(embed_url: str, referer: str) -> Optional[str]:
         response = await async_client.get(embed_url, headers=headers)
         response.raise_for_status()
         
-        patterns = [
-            r'file:\s*"([^"]+)"',
-            r'<source\s+src="([^"]+)"',
-            r'"fileURL":"([^"]+)"',
-            r'(https?://[^\s"\'<>`]+?\.(?:mp4|m3u8|mkv|webm)[^\s"\'<>`]*)'
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, response.text)
-            if match:
-                video_url = match.group(1).strip().replace('\\/', '/')
-                return urljoin(embed_url, video_url)
+        match = _EMBED_RE.search(response.text)
+        if match:
+            video_url = match.group(match.lastgroup).strip().replace('\\/', '/')
+            return urljoin(embed_url, video_url)
     except Exception as e:
         logger.error(f"Error scraping embed: {e}")
     return None
 
+async def run_parse_media(html: bytes, base_url: str) -> tuple[dict, list, Optional[str]]:
+    """Run parse_media in the parse pool, rebuilding the pool if a worker died"""
+    global parse_pool
+    pool = parse_pool
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, parse_media, html, base_url)
+    except BrokenProcessPool:
+        # Concurrent callers fail together, only the first one rebuilds
+        if parse_pool is pool:
+            logger.warning("Parse pool broken, restarting it")
+            pool.shutdown(wait=False, cancel_futures=True)
+            parse_pool = _new_parse_pool()
+        return parse_media(html, base_url)
+
 async def extract_media_from_page(url: str) -> tuple[dict, Optional[str], Optional[str]]:
     """Extract media URLs from page"""
     media_urls = {"images": [], "videos": [], "gifs": []}
@@ -218,42 +412,15 @@ async def extract_media_from_page(url: str) -> tuple[dict, Optional[str], Option
     try:
         response = await async_client.get(url)
         response.raise_for_status()
-        soup = BeautifulSoup(response.content, "html.parser")
-        
-        # Extract direct media links
-        for tag in soup.find_all(['a', 'img', 'video', 'source']):
-            for attr in ['href', 'src', 'data-src']:
-                link = tag.get(attr)
-                if not link: continue
-                
-                full_url = urljoin(url, link)
-                if any(p in full_url for p in IGNORED_MEDIA_PATTERNS): continue
-                
-                path = urlparse(full_url).path.lower()
-                if any(path.endswith(ext) for ext in [".jpg", ".jpeg", ".png", ".webp"]):
-                    if full_url not in media_urls["images"]: 
-                        media_urls["images"].append(full_url)
-                elif path.endswith(".gif"):
-                    if full_url not in media_urls["gifs"]: 
-                        media_urls["gifs"].append(full_url)
-                elif any(path.endswith(ext) for ext in [".mp4", ".webm", ".mov"]):
-                    if full_url not in media_urls["videos"]: 
-                        media_urls["videos"].append(full_url)
+        media_urls, iframe_urls, next_page_url = await run_parse_media(response.content, url)
         
         # Extract from iframes
-        for iframe in soup.find_all('iframe'):
-            iframe_src = iframe.get('src')
-            if iframe_src:
-                video_url = await scrape_embedded_video(urljoin(url, iframe_src), url)
-                if video_url and video_url not in media_urls["videos"]:
-                    media_urls["videos"].append(video_url)
-        
-        # Find next page
-        next_tag = soup.find("a", class_="pageNav-jump--next") or \
-                   soup.find("a", rel="next") or \
-                   soup.find("a", string=re.compile(r"^\s*Next\s*$", re.IGNORECASE))
-        if next_tag and next_tag.get("href"):
-            next_page_url = urljoin(url, next_tag['href'])
+        seen_videos = set(media_urls["videos"])
+        for iframe_url in iframe_urls:
+            video_url = await scrape_embedded_video(iframe_url, url)
+            if video_url and video_url not in seen_videos:
+                seen_videos.add(video_url)
+                media_urls["videos"].append(video_url)
     
     except Exception as e:
         logger.error(f"Error extracting media: {e}")
@@ -265,126 +432,214 @@ async def extract_media_from_page(url: str) -> tuple[dict, Optional[str], Option
         "gifs": media_urls["gifs"][:10]
     }, None, next_page_url
 
-async def download_media_as_bytes(url: str, referer: Optional[str] = None) -> Optional[io.BytesIO]:
-    """Download media file as bytes"""
+async def download_media_as_bytes(url: str, referer: Optional[str] = None) -> Optional[IO[bytes]]:
+    """Download media file, spilling to disk when larger than DOWNLOAD_SPOOL_SIZE"""
+    spool = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_SIZE)
     try:
         headers = {'Referer': referer} if referer else {}
-        response = await async_client.get(url, headers=headers)
-        response.raise_for_status()
-        return io.BytesIO(response.content)
+        async with DOWNLOAD_SEMAPHORE:
+            async with async_client.stream("GET", url, headers=headers) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    spool.write(chunk)
+        spool.seek(0)
+        return spool
     except Exception as e:
         logger.warning(f"Download failed for {url}: {e}")
+        spool.close()
+        return None
+    except asyncio.CancelledError:
+        spool.close()
+        raise
+
+def _webp_to_jpeg(buf: IO[bytes]) -> Optional[io.BytesIO]:
+    """Convert WebP image to JPEG, returns None on failure"""
+    try:
+        with Image.open(buf) as img:
+            img = img.convert("RGB")
+            output = io.BytesIO()
+            img.save(output, format="JPEG")
+            output.seek(0)
+            return output
+    except Exception as e:
+        logger.error(f"WebP conversion failed: {e}")
         return None
 
-async def _send_with_retry(send_method, **kwargs):
-    """Send with retry logic for flood control"""
+async def _send_with_retry(send_method, **kwargs) -> bool:
+    """Send with retry logic for flood control, returns True once sent"""
+    global flood_wait_until
     for attempt in range(3):
         try:
             # Reset file pointers
             for key in ['video', 'animation', 'thumbnail']:
-                if key in kwargs and isinstance(kwargs.get(key), io.BytesIO):
+                if key in kwargs and isinstance(kwargs.get(key), io.IOBase):
                     kwargs[key].seek(0)
             if 'media' in kwargs:
                 for item in kwargs['media']:
-                    if isinstance(item.media, io.BytesIO): 
+                    if isinstance(item.media, io.IOBase):
                         item.media.seek(0)
             
+            # Pause every sender while a flood wait is in effect
+            delay = flood_wait_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            
+            # Telegram counts every photo of an album as a message
+            await SEND_LIMITER.acquire(len(kwargs.get("media", ())) or 1)
             await send_method(**kwargs)
-            await asyncio.sleep(2)  # Rate limit protection
-            return
+            return True
         except RetryAfter as e:
             logger.warning(f"Flood control. Waiting {e.retry_after}s...")
-            await asyncio.sleep(e.retry_after)
+            flood_wait_until = max(flood_wait_until, time.monotonic() + e.retry_after)
         except TelegramError as e:
             logger.error(f"Telegram error: {e}")
             if attempt == 2:
-                return
+                return False
             await asyncio.sleep(5)
+    return False
+
+def _start_downloads(urls: list, referer: Optional[str] = None) -> list:
+    """Start concurrent download tasks for urls"""
+    return [asyncio.create_task(download_media_as_bytes(url, referer)) for url in urls]
+
+def _discard_downloads(tasks: list):
+    """Cancel pending downloads and close files of finished ones"""
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and task.result():
+            task.result().close()
 
 async def send_images(bot: Bot, urls: list, referer: str, chat_id: Optional[int] = None):
     """Send images in groups of 10"""
     if not urls: return
     
-    media_group = []
-    for url in urls:
-        if cancellation_flags.get(chat_id):
-            raise asyncio.CancelledError
-        
-        image_bytes = await download_media_as_bytes(url, referer)
-        if image_bytes:
-            SENT_MEDIA_URLS.add(url)
+    chunks = [urls[i:i + MEDIA_GROUP_SIZE] for i in range(0, len(urls), MEDIA_GROUP_SIZE)]
+    # Prefetch the next chunk while the current one uploads
+    pending = _start_downloads(chunks[0], referer)
+    current = []
+    
+    try:
+        for index, chunk in enumerate(chunks):
+            if cancellation_flags.get(chat_id):
+                raise asyncio.CancelledError
             
-            # Convert WebP to JPEG
-            if url.lower().endswith(".webp"):
-                try:
-                    with Image.open(image_bytes) as img:
-                        img = img.convert("RGB")
-                        output = io.BytesIO()
-                        img.save(output, format="JPEG")
-                        output.seek(0)
-                        image_bytes = output
-                except Exception as e:
-                    logger.error(f"WebP conversion failed: {e}")
-                    continue
+            current, pending = pending, []
+            downloads = await asyncio.gather(*current)
+            if index + 1 < len(chunks):
+                pending = _start_downloads(chunks[index + 1], referer)
             
-            media_group.append(InputMediaPhoto(media=image_bytes))
+            media_group = []
+            group_urls = []
+            for url, image_bytes in zip(chunk, downloads):
+                if not image_bytes: continue
+                
+                filename = url_basename(url) or "image.jpg"
+                
+                # Convert WebP to JPEG
+                if url.lower().endswith(".webp"):
+                    download = image_bytes
+                    image_bytes = await asyncio.get_running_loop().run_in_executor(
+                        None, _webp_to_jpeg, download
+                    )
+                    download.close()
+                    if image_bytes is None:
+                        continue
+                    filename = os.path.splitext(filename)[0] + ".jpg"
+                
+                # InputMediaPhoto reads the file right away, so it can be closed after
+                media_group.append(InputMediaPhoto(media=image_bytes, filename=filename))
+                group_urls.append(url)
+                image_bytes.close()
             
-            if len(media_group) == 10:
-                await _send_with_retry(bot.send_media_group, chat_id=CHANNEL_ID, media=media_group)
-                media_group = []
-    
-    if media_group:
-        await _send_with_retry(bot.send_media_group, chat_id=CHANNEL_ID, media=media_group)
+            if media_group:
+                if await _send_with_retry(bot.send_media_group, chat_id=CHANNEL_ID, media=media_group):
+                    sent_cache.add_many(group_urls)
+    finally:
+        _discard_downloads(current)
+        _discard_downloads(pending)
 
 async def send_videos(bot: Bot, urls: list, referer: str, chat_id: Optional[int] = None):
     """Send videos one by one"""
     if not urls: return
     
-    for url in urls:
-        if cancellation_flags.get(chat_id):
-            raise asyncio.CancelledError
-        
-        video_bytes = await download_media_as_bytes(url, referer)
-        if video_bytes:
-            SENT_MEDIA_URLS.add(url)
-            filename = os.path.basename(urlparse(url).path) or f"video_{int(time.time())}.mp4"
+    # Prefetch the next video while the current one uploads
+    pending = _start_downloads(urls[:1], referer)
+    current = []
+    
+    try:
+        for index, url in enumerate(urls):
+            if cancellation_flags.get(chat_id):
+                raise asyncio.CancelledError
             
-            try:
-                await _send_with_retry(
-                    bot.send_video,
-                    chat_id=CHANNEL_ID,
-                    video=video_bytes,
-                    filename=filename,
-                    supports_streaming=True,
-                    write_timeout=60
-                )
-            except Exception as e:
-                logger.error(f"Error sending video: {e}")
+            current, pending = pending, []
+            video_bytes = await current[0]
+            if index + 1 < len(urls):
+                pending = _start_downloads(urls[index + 1:index + 2], referer)
+            
+            if video_bytes:
+                filename = url_basename(url) or f"video_{int(time.time())}.mp4"
+                
+                try:
+                    if await _send_with_retry(
+                        bot.send_video,
+                        chat_id=CHANNEL_ID,
+                        video=video_bytes,
+                        filename=filename,
+                        supports_streaming=True,
+                        write_timeout=60
+                    ):
+                        sent_cache.add_many([url])
+                except Exception as e:
+                    logger.error(f"Error sending video: {e}")
+                finally:
+                    video_bytes.close()
+    finally:
+        _discard_downloads(current)
+        _discard_downloads(pending)
+
+# ========================
+# UI CONSTANTS
+# ========================
+_MAIN_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🎬 Video Link Extractor", callback_data="mode_video_links")],
+    [InlineKeyboardButton("🖼️ Media Scraper", callback_data="mode_media_scraper")],
+    [InlineKeyboardButton("ℹ️ Help", callback_data="help")]
+])
+
+_WELCOME_TEXT = (
+    "🤖 *Professional Media Extractor Bot*\n\n"
+    "Choose your extraction mode:\n\n"
+    "🎬 *Video Link Extractor*\n"
+    "Extract video download links from pages\n\n"
+    "🖼️ *Media Scraper*\n"
+    "Download and send images/videos to channel\n\n"
+    "Select a mode to get started\\!"
+)
+
+_MENU_TEXT = "🤖 *Professional Media Extractor Bot*\n\nChoose your mode:"
+
+_HELP_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("« Back", callback_data="back")]])
+
+_HELP_TEXT = (
+    "📚 *Help Guide*\n\n"
+    "*Commands:*\n"
+    "/start \\- Select mode\n"
+    "/cancel \\- Stop processing\n"
+    "/id \\- Get chat ID\n\n"
+    "*Modes:*\n"
+    "• Video Link Extractor: Get download links\n"
+    "• Media Scraper: Auto\\-download to channel"
+)
 
 # ========================
 # COMMAND HANDLERS
 # ========================
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
-    keyboard = [
-        [InlineKeyboardButton("🎬 Video Link Extractor", callback_data="mode_video_links")],
-        [InlineKeyboardButton("🖼️ Media Scraper", callback_data="mode_media_scraper")],
-        [InlineKeyboardButton("ℹ️ Help", callback_data="help")]
-    ]
-    
-    welcome_text = (
-        "🤖 *Professional Media Extractor Bot*\n\n"
-        "Choose your extraction mode:\n\n"
-        "🎬 *Video Link Extractor*\n"
-        "Extract video download links from pages\n\n"
-        "🖼️ *Media Scraper*\n"
-        "Download and send images/videos to channel\n\n"
-        "Select a mode to get started\\!"
-    )
-    
     await update.message.reply_text(
-        welcome_text,
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        _WELCOME_TEXT,
+        reply_markup=_MAIN_KEYBOARD,
         parse_mode=ParseMode.MARKDOWN_V2
     )
 
@@ -413,20 +668,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(text, parse_mode=ParseMode.MARKDOWN_V2)
     
     elif query.data == "help":
-        help_text = (
-            "📚 *Help Guide*\n\n"
-            "*Commands:*\n"
-            "/start \\- Select mode\n"
-            "/cancel \\- Stop processing\n"
-            "/id \\- Get chat ID\n\n"
-            "*Modes:*\n"
-            "• Video Link Extractor: Get download links\n"
-            "• Media Scraper: Auto\\-download to channel"
-        )
-        keyboard = [[InlineKeyboardButton("« Back", callback_data="back")]]
         await query.edit_message_text(
-            help_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            _HELP_TEXT,
+            reply_markup=_HELP_KEYBOARD,
             parse_mode=ParseMode.MARKDOWN_V2
         )
     
@@ -435,15 +679,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def start_command_from_callback(query):
     """Recreate start menu from callback"""
-    keyboard = [
-        [InlineKeyboardButton("🎬 Video Link Extractor", callback_data="mode_video_links")],
-        [InlineKeyboardButton("🖼️ Media Scraper", callback_data="mode_media_scraper")],
-        [InlineKeyboardButton("ℹ️ Help", callback_data="help")]
-    ]
-    text = "🤖 *Professional Media Extractor Bot*\n\nChoose your mode:"
     await query.edit_message_text(
-        text,
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        _MENU_TEXT,
+        reply_markup=_MAIN_KEYBOARD,
         parse_mode=ParseMode.MARKDOWN_V2
     )
 
@@ -452,6 +690,13 @@ async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     if processing_tasks.get(chat_id):
         cancellation_flags[chat_id] = True
+        
+        # Drop jobs waiting behind the current one
+        queue = chat_queues.get(chat_id)
+        while queue and not queue.empty():
+            queue.get_nowait()
+            queue.task_done()
+        
         await update.message.reply_text(
             escape_markdown_v2("🚫 Cancellation initiated..."),
             parse_mode=ParseMode.MARKDOWN_V2
@@ -472,17 +717,46 @@ async def id_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ========================
 # MESSAGE HANDLER
 # ========================
+async def _chat_worker(chat_id: int, queue: asyncio.Queue):
+    """Run a chat's jobs one at a time, in the order they were sent"""
+    while True:
+        update, context, mode, urls = await queue.get()
+        try:
+            if mode == "video_links":
+                task = context.application.create_task(
+                    process_video_links(update, context, urls)
+                )
+            else:
+                task = context.application.create_task(
+                    process_media_scraper(update, context, urls)
+                )
+            
+            processing_tasks[chat_id] = task
+            await task
+        except Exception as e:
+            logger.error(f"Error in chat worker {chat_id}: {e}")
+        finally:
+            queue.task_done()
+
+def enqueue_job(update: Update, context: ContextTypes.DEFAULT_TYPE, mode: str, urls: list):
+    """Queue a job for the chat's worker, starting the worker on first use"""
+    chat_id = update.effective_chat.id
+    queue = chat_queues.get(chat_id)
+    if queue is None:
+        queue = chat_queues[chat_id] = asyncio.Queue()
+        chat_workers[chat_id] = asyncio.create_task(_chat_worker(chat_id, queue))
+    queue.put_nowait((update, context, mode, urls))
+
+async def stop_chat_workers(application):
+    """Stop idle chat workers on shutdown"""
+    for worker in chat_workers.values():
+        worker.cancel()
+    await asyncio.gather(*chat_workers.values(), return_exceptions=True)
+
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Main message handler"""
     chat_id = update.effective_chat.id
     
-    if processing_tasks.get(chat_id):
-        await update.message.reply_text(
-            escape_markdown_v2("⚠️ A process is running. Use /cancel first."),
-            parse_mode=ParseMode.MARKDOWN_V2
-        )
-        return
-    
     mode = user_modes.get(chat_id)
     if not mode:
         await update.message.reply_text(
@@ -501,16 +775,12 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         
-        if mode == "video_links":
-            task = context.application.create_task(
-                process_video_links(update, context, urls)
-            )
-        else:
-            task = context.application.create_task(
-                process_media_scraper(update, context, urls)
+        if processing_tasks.get(chat_id):
+            await update.message.reply_text(
+                escape_markdown_v2("⏳ Queued, will start after the current process."),
+                parse_mode=ParseMode.MARKDOWN_V2
             )
-        
-        processing_tasks[chat_id] = task
+        enqueue_job(update, context, mode, urls)
     
     # Handle .txt files
     elif update.message.document and update.message.document.mime_type == "text/plain":
@@ -520,14 +790,10 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         
         file = await context.bot.get_file(update.message.document.file_id)
-        file_path = os.path.join(DOWNLOAD_DIR, f"{update.message.document.file_id}.txt")
-        await file.download_to_drive(file_path)
+        content = (await file.download_as_bytearray()).decode('utf-8', errors='ignore')
         
         # Read URLs from file
-        with open(file_path, 'r', encoding='utf-8') as f:
-            urls = [line.strip() for line in f if line.strip().startswith('http')]
-        
-        os.remove(file_path)
+        urls = _URL_LINE_RE.findall(content)
         
         if not urls:
             await update.message.reply_text(
@@ -536,16 +802,12 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         
-        if mode == "video_links":
-            task = context.application.create_task(
-                process_video_links(update, context, urls)
-            )
-        else:
-            task = context.application.create_task(
-                process_media_scraper(update, context, urls)
+        if processing_tasks.get(chat_id):
+            await update.message.reply_text(
+                escape_markdown_v2("⏳ Queued, will start after the current process."),
+                parse_mode=ParseMode.MARKDOWN_V2
             )
-        
-        processing_tasks[chat_id] = task
+        enqueue_job(update, context, mode, urls)
 
 # ========================
 # PROCESSING FUNCTIONS
@@ -559,23 +821,25 @@ async def process_video_links(update: Update, context: ContextTypes.DEFAULT_TYPE
         parse_mode=ParseMode.MARKDOWN_V2
     )
     
-    all_links = []
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_PAGES)
     
-    try:
-        for url in urls:
+    async def extract_page(url):
+        async with semaphore:
             if cancellation_flags.get(chat_id):
-                break
-            
-            if not url.startswith('http'):
-                url = 'https://' + url
-            
-            links = extract_video_links(url)
-            all_links.extend(links)
-            await asyncio.sleep(1)
+                return []
+            return await extract_video_links(url)
+    
+    try:
+        urls = [url if url.startswith('http') else 'https://' + url for url in urls]
+        results = await asyncio.gather(*(extract_page(url) for url in urls))
+        all_links = [link for links in results for link in links]
         
         if all_links:
-            # Remove duplicates
-            unique_links = list(dict(all_links).items())
+            # Remove duplicate URLs, keeping the first title seen
+            first_seen = {}
+            for title, link in all_links:
+                first_seen.setdefault(link, (title, link))
+            unique_links = list(first_seen.values())
             
             # Save to file
             temp_file = os.path.join(DOWNLOAD_DIR, f"links_{chat_id}_{int(time.time())}.txt")
@@ -608,6 +872,7 @@ async def process_video_links(update: Update, context: ContextTypes.DEFAULT_TYPE
     finally:
         processing_tasks.pop(chat_id, None)
         cancellation_flags.pop(chat_id, None)
+        make_absolute_url.cache_clear()
         if status_msg:
             await status_msg.delete()
 
@@ -620,35 +885,53 @@ async def process_media_scraper(update: Update, context: ContextTypes.DEFAULT_TY
         parse_mode=ParseMode.MARKDOWN_V2
     )
     
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_PAGES)
+    
+    async def scrape_page(url):
+        async with semaphore:
+            if cancellation_flags.get(chat_id):
+                return url, None
+            media, _, _ = await extract_media_from_page(url)
+            return url, media
+    
+    urls = [url if url.startswith('http') else 'https://' + url for url in urls]
+    tasks = [asyncio.create_task(scrape_page(url)) for url in urls]
+    
     try:
-        for i, url in enumerate(urls):
+        sent_before = False
+        for i, next_done in enumerate(asyncio.as_completed(tasks)):
             if cancellation_flags.get(chat_id):
                 break
             
-            if not url.startswith('http'):
-                url = 'https://' + url
+            url, media = await next_done
+            if not media:
+                continue
             
             await update_status_safe(
                 status_msg,
-                escape_markdown_v2(f"Processing {i+1}/{len(urls)}: {url[:50]}...")
+                escape_markdown_v2(f"Processing {i+1}/{len(urls)}: {url[:50]}..."),
+                throttle=True
             )
             
-            media, _, _ = await extract_media_from_page(url)
-            
             # Filter new media
             new_media = {
-                key: [u for u in urls_list if u not in SENT_MEDIA_URLS]
-                for key, urls_list in media.items()
+                key: sent_cache.filter_new(urls_list)
+                for key, urls_list in media.items() if urls_list
             }
             
+            if not (new_media.get("images") or new_media.get("videos")):
+                continue
+            
+            # Throttle sends between pages, scraping keeps running meanwhile
+            if sent_before:
+                await asyncio.sleep(LINK_PROCESSING_INTERVAL)
+            sent_before = True
+            
             # Send media
             if new_media.get("images"):
                 await send_images(context.bot, new_media["images"], url, chat_id)
             if new_media.get("videos"):
                 await send_videos(context.bot, new_media["videos"], url, chat_id)
-            
-            if i < len(urls) - 1:
-                await asyncio.sleep(LINK_PROCESSING_INTERVAL)
         
         await update_status_safe(
             status_msg,
@@ -666,6 +949,9 @@ async def process_media_scraper(update: Update, context: ContextTypes.DEFAULT_TY
             escape_markdown_v2(f"❌ Error: {str(e)[:100]}")
         )
     finally:
+        for task in tasks:
+            task.cancel()
+        status_edit_times.pop((status_msg.chat_id, status_msg.message_id), None)
         processing_tasks.pop(chat_id, None)
         cancellation_flags.pop(chat_id, None)
 
@@ -674,10 +960,21 @@ async def process_media_scraper(update: Update, context: ContextTypes.DEFAULT_TY
 # ========================
 def main():
     """Main entry point"""
+    global async_client, sent_cache, parse_pool
     if not BOT_TOKEN:
         logger.critical("BOT_TOKEN not set!")
         return
     
+    async_client = httpx.AsyncClient(
+        headers=HTTP_HEADERS,
+        follow_redirects=True,
+        timeout=30,
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=30)
+    )
+    sent_cache = SentCache(SENT_CACHE_PATH, SENT_CACHE_MAX_ENTRIES)
+    parse_pool = _new_parse_pool()
+    
     # Check ffmpeg (non-blocking)
     has_ffmpeg = check_ffmpeg()
     if not has_ffmpeg:
@@ -689,6 +986,7 @@ def main():
         .connect_timeout(30) \
         .read_timeout(30) \
         .write_timeout(60) \
+        .post_stop(stop_chat_workers) \
         .build()
     
     # Add handlers
@@ -705,7 +1003,11 @@ def main():
     logger.info(f"FFmpeg: {'✅ Available' if has_ffmpeg else '⚠️ Not available'}")
     
     # Run bot
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    try:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
+    finally:
+        sent_cache.close()
+        parse_pool.shutdown(cancel_futures=True)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,89 @@
+import os
+import re
+import functools
+from typing import Optional
+from urllib.parse import urljoin
+
+from selectolax.parser import HTMLParser
+
+# This module runs inside the parse pool workers, keep it free of
+# import-time side effects (clients, files, pools).
+
+# ========================
+# CONFIGURATION
+# ========================
+IGNORED_MEDIA_PATTERNS = [
+    "/avatars/", "/styles/", "/smilies/", "/assets/",
+    "cdninstagram.com", "/addonflare/", "/icons/"
+]
+
+# ========================
+# COMPILED PATTERNS
+# ========================
+_AUTHORITY_RE = re.compile(r'^(?:[a-z][a-z0-9+.-]*:)?//[^/?#]*', re.IGNORECASE)
+_BASENAME_RE = re.compile(r'/([^/?#]+?)(?:\?|#|$)')
+_NEXT_TEXT_RE = re.compile(r'^\s*Next\s*$', re.IGNORECASE)
+_IGNORED_RE = re.compile("|".join(re.escape(p) for p in IGNORED_MEDIA_PATTERNS))
+_IMG_EXT_RE = re.compile(r'\.(jpe?g|png|webp)$', re.IGNORECASE)
+_GIF_EXT_RE = re.compile(r'\.gif$', re.IGNORECASE)
+_MEDIA_VIDEO_EXT_RE = re.compile(r'\.(mp4|webm|mov)$', re.IGNORECASE)
+
+# ========================
+# PARSING FUNCTIONS
+# ========================
+def url_basename(url: str) -> str:
+    """Get last path segment of URL without query or fragment"""
+    authority = _AUTHORITY_RE.match(url)
+    path_start = authority.end() if authority else 0
+    # Path-less URLs like https://host?u=/a.jpg have no basename
+    if not url.startswith('/', path_start): return ""
+    match = _BASENAME_RE.search(url, path_start)
+    return match.group(1) if match else ""
+
+@functools.lru_cache(maxsize=64)
+def _classify_extension(ext: str) -> Optional[str]:
+    """Map lowercase file extension to media category"""
+    if _IMG_EXT_RE.search(ext): return "images"
+    if _GIF_EXT_RE.search(ext): return "gifs"
+    if _MEDIA_VIDEO_EXT_RE.search(ext): return "videos"
+    return None
+
+def parse_media(html: bytes, base_url: str) -> tuple[dict, list, Optional[str]]:
+    """Parse media URLs, iframe sources and next page URL from HTML"""
+    media_urls = {"images": [], "videos": [], "gifs": []}
+    seen_urls = {"images": set(), "videos": set(), "gifs": set()}
+    iframe_urls = []
+    next_page_url = None
+    
+    dom = HTMLParser(html)
+    
+    # Extract direct media links
+    for tag in dom.css('a, img, video, source'):
+        for attr in ['href', 'src', 'data-src']:
+            link = tag.attributes.get(attr)
+            if not link: continue
+            
+            full_url = urljoin(base_url, link)
+            if _IGNORED_RE.search(full_url): continue
+            
+            ext = os.path.splitext(url_basename(full_url))[1].lower()
+            category = _classify_extension(ext)
+            if category and full_url not in seen_urls[category]:
+                seen_urls[category].add(full_url)
+                media_urls[category].append(full_url)
+    
+    # Collect iframes, scraped later by the caller
+    for iframe in dom.css('iframe'):
+        iframe_src = iframe.attributes.get('src')
+        if iframe_src:
+            iframe_urls.append(urljoin(base_url, iframe_src))
+    
+    # Find next page
+    next_tag = dom.css_first("a.pageNav-jump--next, a[rel~=next]") or next(
+        (a for a in dom.css("a") if _NEXT_TEXT_RE.match(a.text())),
+        None
+    )
+    if next_tag and next_tag.attributes.get("href"):
+        next_page_url = urljoin(base_url, next_tag.attributes["href"])
+    
+    return media_urls, iframe_urls, next_page_url